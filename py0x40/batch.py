@@ -0,0 +1,211 @@
+import argparse
+import json
+from multiprocessing import Pool
+import os
+import sys
+import time
+import traceback
+
+from cache import FileCache
+from py0x40 import Hues0x40, PROFILES
+from respack import load_respack, Resources
+
+
+class Job(object):
+
+    def __init__(self, index, entry):
+
+        profile = PROFILES[entry.get('profile', 'full')]
+
+        self.index = index
+        self.song = entry['song']
+        self.respack_filenames = list(entry['respacks'])
+        self.duration = float(entry['duration'])
+        self.scale = parse_resolution(entry.get('resolution', profile['scale']))
+        self.fps = float(entry.get('fps', profile['fps']))
+        self.preset = entry.get('preset', profile['preset'])
+        self.crf = entry.get('crf', profile['crf'])
+        self.backend = entry.get('backend', 'pygame')
+        self.min_realtime = entry.get('min_realtime', profile['min_realtime'])
+        self.output_filename = entry['output']
+
+
+class JobResult(object):
+
+    def __init__(self, job, frames=0, setup_time=0.0, render_time=0.0, error=None):
+
+        self.job = job
+        self.frames = frames
+        self.setup_time = setup_time
+        self.render_time = render_time
+        self.error = error
+
+    @property
+    def ok(self):
+
+        return self.error is None
+
+    @property
+    def slow(self):
+
+        return self.ok and self.job.min_realtime is not None and self.realtime_factor < self.job.min_realtime
+
+    @property
+    def fps(self):
+
+        return self.frames / self.render_time if self.render_time > 0 else 0.0
+
+    @property
+    def realtime_factor(self):
+
+        return self.job.duration / self.render_time if self.render_time > 0 else 0.0
+
+    def to_dict(self):
+
+        return {
+            'index': self.job.index,
+            'song': self.job.song,
+            'output': self.job.output_filename,
+            'ok': self.ok,
+            'frames': self.frames,
+            'setup_time': self.setup_time,
+            'render_time': self.render_time,
+            'fps': self.fps,
+            'realtime_factor': self.realtime_factor,
+            'min_realtime': self.job.min_realtime,
+            'slow': self.slow,
+            'error': self.error
+        }
+
+
+def parse_resolution(resolution):
+
+    if isinstance(resolution, str):
+        width, height = resolution.lower().split('x')
+        return int(width), int(height)
+
+    width, height = resolution
+    return int(width), int(height)
+
+
+def load_manifest(filename):
+
+    with open(filename, 'r') as f:
+        entries = json.load(f)
+
+    return [Job(i, entry) for i, entry in enumerate(entries)]
+
+
+def default_workers(encoder_threads):
+
+    # every job runs one render process plus an ffmpeg encoder using encoder_threads cores
+    return max(1, (os.cpu_count() or 1) // (1 + encoder_threads))
+
+
+_respacks = None
+_cache = None
+_encoder_threads = None
+
+
+def _init_worker(respacks, cache_directory, encoder_threads):
+
+    global _respacks, _cache, _encoder_threads
+
+    _respacks = respacks
+    _cache = FileCache(cache_directory)
+    _encoder_threads = encoder_threads
+
+
+def _run_job(job):
+
+    start_t = time.time()
+    hues = None
+
+    try:
+        resources = Resources(respacks=[_respacks[fn] for fn in job.respack_filenames], cache=_cache)
+        hues = Hues0x40(scale=job.scale, fps=job.fps, song=job.song, output_filename=job.output_filename, resources=resources, encoder_threads=_encoder_threads, cache=_cache, preset=job.preset, crf=job.crf, backend=job.backend, verbose=False)
+        setup_time = time.time() - start_t
+
+        render_start_t = time.time()
+        hues.play(job.duration)
+        hues.close()
+        hues = None
+
+        return JobResult(job, frames=int(job.duration * job.fps), setup_time=setup_time, render_time=time.time() - render_start_t)
+
+    except Exception:
+        return JobResult(job, setup_time=time.time() - start_t, error=traceback.format_exc())
+
+    finally:
+        if hues is not None:
+            hues.close()
+
+
+def run_batch(jobs, workers=None, encoder_threads=2, cache_directory=None):
+
+    if workers is None:
+        workers = default_workers(encoder_threads)
+
+    cache = FileCache(cache_directory)
+
+    # parse each respack once up front; the index is shared read-only with every worker
+    respacks = {}
+    for job in jobs:
+        for fn in job.respack_filenames:
+            if fn not in respacks:
+                respacks[fn] = load_respack(fn, cache=cache)
+
+    results = []
+
+    with Pool(workers, initializer=_init_worker, initargs=(respacks, cache.directory, encoder_threads)) as pool:
+
+        for result in pool.imap_unordered(_run_job, jobs):
+
+            if result.ok:
+                print('[%d] %s %s -> %s: %d frames in %.1fs (%.1f fps, %.2fx realtime, setup %.1fs)' % (
+                    result.job.index, 'slow  ' if result.slow else 'ok    ', result.job.song, result.job.output_filename, result.frames,
+                    result.render_time, result.fps, result.realtime_factor, result.setup_time))
+            else:
+                print('[%d] FAILED %s -> %s' % (result.job.index, result.job.song, result.job.output_filename))
+                print(result.error, file=sys.stderr)
+
+            results.append(result)
+
+        # let workers exit on their own; leaving the block terminates them with SIGTERM, which SDL catches
+        pool.close()
+        pool.join()
+
+    return sorted(results, key=lambda result: result.job.index)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Render a manifest of songs to video files.')
+    parser.add_argument('manifest', help='JSON list of jobs with song, respacks, duration, output and optionally profile, resolution, fps, backend, min_realtime')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='number of concurrent jobs (default: based on cpu count and encoder threads)')
+    parser.add_argument('--encoder-threads', type=int, default=2, help='threads given to each ffmpeg encoder')
+    parser.add_argument('--cache-dir', default=None, help='directory for cached spectrograms, image masks, durations and respack indexes (default: shared memory)')
+    parser.add_argument('--report', default=None, help='write per-job results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    jobs = load_manifest(args.manifest)
+
+    start_t = time.time()
+    results = run_batch(jobs, workers=args.workers, encoder_threads=args.encoder_threads, cache_directory=args.cache_dir)
+    elapsed = time.time() - start_t
+
+    failures = [result for result in results if not result.ok]
+    slow = [result for result in results if result.slow]
+    total_frames = sum(result.frames for result in results)
+    print('%d jobs, %d failed, %d below their realtime target, %d frames in %.1fs (%.1f fps overall)' % (len(results), len(failures), len(slow), total_frames, elapsed, total_frames / elapsed if elapsed > 0 else 0.0))
+
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump([result.to_dict() for result in results], f, indent=2)
+
+    return 1 if failures or slow else 0
+
+
+if __name__ == '__main__':
+
+    sys.exit(main())
@@ -0,0 +1,233 @@
+import argparse
+from contextlib import contextmanager
+import hashlib
+import os
+import pickle
+import stat
+from tempfile import gettempdir, mkstemp
+import time
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def file_digest(filename, block_size=1 << 20):
+
+    digest = hashlib.sha1()
+
+    with open(filename, 'rb') as f:
+
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def stat_digest(filename):
+
+    # cheap key for files that are only ever replaced, never edited in place
+    st = os.stat(filename)
+    return hashlib.sha1(('%s:%d:%d' % (os.path.abspath(filename), st.st_mtime_ns, st.st_size)).encode()).hexdigest()
+
+
+# files a writer was still writing when it died; younger ones may belong to a live writer
+PARTIAL_MAX_AGE = 3600
+
+
+def default_directory():
+
+    # /dev/shm is memory backed, so every process on the host maps the same pages
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else gettempdir()
+
+    if hasattr(os, 'getuid'):
+        return os.path.join(base, 'py0x40-cache-%d' % os.getuid())
+
+    return os.path.join(base, 'py0x40-cache')
+
+
+def check_private(directory):
+
+    # entries are unpickled, so anyone who can write here can run code in every renderer
+    if not hasattr(os, 'getuid'):
+        return
+
+    st = os.lstat(directory)
+
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError('Cache directory %s must be a directory owned by uid %d and closed to other users (mode 0700)' % (directory, os.getuid()))
+
+
+class FileCache(object):
+
+    def __init__(self, directory=None):
+
+        if directory is None:
+            directory = default_directory()
+
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        check_private(directory)
+
+        self.directory = directory
+
+    def get_array(self, key, compute):
+
+        # arrays come back as read-only memory maps, shared with every other reader
+        return self._get(key + '.npy', compute, lambda filename: np.load(filename, mmap_mode='r'), lambda value, f: np.save(f, value))
+
+    def get_object(self, key, compute):
+
+        return self._get(key + '.pickle', compute, _load_pickle, pickle.dump)
+
+    def prune(self, max_bytes):
+
+        entries = []
+        total = 0
+
+        for name in os.listdir(self.directory):
+
+            filename = os.path.join(self.directory, name)
+
+            try:
+                st = os.stat(filename)
+            except FileNotFoundError:
+                continue
+
+            if name.endswith('.lock'):
+                self._remove_lock(filename)
+
+            elif name.endswith('.partial'):
+                if time.time() - st.st_mtime > PARTIAL_MAX_AGE:
+                    _remove(filename)
+                else:
+                    total += st.st_size
+
+            elif name.endswith('.npy') or name.endswith('.pickle'):
+                entries.append((st.st_mtime, st.st_size, filename))
+                total += st.st_size
+
+        # drop least recently used entries first; processes that still map them keep their pages
+        for _, size, filename in sorted(entries):
+
+            if total <= max_bytes:
+                break
+
+            _remove(filename)
+            total -= size
+
+        return total
+
+    def _get(self, name, compute, load, dump):
+
+        filename = os.path.join(self.directory, name)
+
+        try:
+            return self._load(filename, load)
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+            pass
+
+        # only one process computes an entry; the others wait for it and then read the result
+        with self._lock(name):
+
+            try:
+                return self._load(filename, load)
+            except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+                pass
+
+            value = compute()
+
+            # write to a temporary name first so that concurrent readers never see a partial file
+            fd, temp_filename = mkstemp(dir=self.directory, suffix='.partial')
+            with os.fdopen(fd, 'wb') as f:
+                dump(value, f)
+            os.replace(temp_filename, filename)
+
+        return load(filename)
+
+    def _load(self, filename, load):
+
+        value = load(filename)
+
+        # access times are unreliable under relatime, so last use is recorded in the mtime
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+
+        return value
+
+    @contextmanager
+    def _lock(self, name):
+
+        if fcntl is None:
+            yield
+            return
+
+        filename = os.path.join(self.directory, name + '.lock')
+
+        while True:
+
+            f = open(filename, 'a')
+            fcntl.flock(f, fcntl.LOCK_EX)
+
+            # prune may have removed the lock file while this process waited on it
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(filename).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+
+            f.close()
+
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+    def _remove_lock(self, filename):
+
+        if fcntl is None:
+            return
+
+        # only locks nobody holds are removed; a waiter that loses its file notices and retries
+        try:
+            with open(filename, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                _remove(filename)
+        except (BlockingIOError, FileNotFoundError):
+            pass
+
+
+def _remove(filename):
+
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
+def _load_pickle(filename):
+
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Inspect or prune the shared asset cache.')
+    parser.add_argument('--dir', default=None, help='cache directory (default: %s)' % default_directory())
+    parser.add_argument('--max-mb', type=float, default=None, help='remove least recently used entries, unused locks and abandoned partial writes until the cache fits')
+    args = parser.parse_args()
+
+    cache = FileCache(args.dir)
+
+    if args.max_mb is not None:
+        total = cache.prune(int(args.max_mb * 1024 * 1024))
+    else:
+        total = sum(os.path.getsize(os.path.join(cache.directory, name)) for name in os.listdir(cache.directory))
+
+    print('%s: %.1f MB' % (cache.directory, total / (1024 * 1024)))
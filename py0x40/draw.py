@@ -1,53 +1,59 @@
-from itertools import repeat
+from collections import OrderedDict
+from itertools import count
 
 import numpy as np
 
-from pygame import image, Surface, surfarray, transform
+from pygame import image, Rect, Surface, surfarray, transform
 
 
 class Image(object):
 
-    def __init__(self, f, namehint=None, height=720):
+    def __init__(self, f=None, namehint=None, height=720, mask=None):
 
-        if namehint is None:
-            self.surface = image.load(f).convert_alpha()
-        else:
-            self.surface = image.load(f, namehint).convert_alpha()
+        if mask is None:
+
+            if namehint is None:
+                self.surface = image.load(f).convert_alpha()
+            else:
+                self.surface = image.load(f, namehint).convert_alpha()
+
+            old_width = self.surface.get_width()
+            old_height = self.surface.get_height()
 
-        old_width = self.surface.get_width()
-        old_height = self.surface.get_height()
+            # if image is black with transparency, this will safely convert to black and white
+            new_surface = self.surface.convert()
+            new_surface.fill((255, 255, 255))
+            new_surface.blit(self.surface, (0, 0))
+            self.surface = new_surface
 
-        # if image is black with transparency, this will safely convert to black and white
-        new_surface = self.surface.convert()
-        new_surface.fill((255, 255, 255))
-        new_surface.blit(self.surface, (0, 0))
-        self.surface = new_surface
+            self.width = int(old_width * height / old_height)
+            self.height = height
+            if old_height < height:
+                self.surface = transform.scale(transform.scale2x(self.surface), (self.width, self.height)).convert_alpha()
+            else:
+                self.surface = transform.scale(self.surface, (self.width, self.height)).convert_alpha()
+
+            # set alpha channel to average of rgb
+            arr_rgb = surfarray.pixels3d(self.surface)
+            arr_rgb[:, :, :] = 255 - arr_rgb
+            arr_alpha = surfarray.pixels_alpha(self.surface)
+            arr_alpha[:, :] = arr_rgb[:, :, :3].sum(2) // 3
+
+            mask = np.ascontiguousarray(arr_alpha.T)
 
-        self.width = int(old_width * height / old_height)
-        self.height = height
-        if old_height < height:
-            self.surface = transform.scale(transform.scale2x(self.surface), (self.width, self.height)).convert_alpha()
         else:
-            self.surface = transform.scale(self.surface, (self.width, self.height)).convert_alpha()
 
-        # set alpha channel to average of rgb
-        arr_rgb = surfarray.pixels3d(self.surface)
-        arr_rgb[:, :, :] = 255 - arr_rgb
-        arr_alpha = surfarray.pixels_alpha(self.surface)
-        arr_alpha[:, :] = arr_rgb[:, :, :3].sum(2) // 3
+            # an already processed mask, e.g. from a shared cache; only the surface has to be rebuilt
+            self.height, self.width = mask.shape
+            self.surface = Surface((self.width, self.height)).convert_alpha()
+            surfarray.pixels_alpha(self.surface)[:, :] = mask.T
+
+        self.mask = mask
+        self.blur_engines = {}
     
     def set_color(self, color):
 
         surfarray.pixels3d(self.surface)[:, :, :] = np.array(color)[None, None, :]
-    
-    def alpha_scale(self, alpha_scale=1.0):
-
-        new_surface = self.surface.convert_alpha()
-
-        arr_alpha = surfarray.pixels_alpha(new_surface)
-        arr_alpha[:, :] = (alpha_scale * arr_alpha).astype(np.uint8)
-
-        return new_surface
 
 
 class AnimationManager(object):
@@ -64,32 +70,186 @@ class AnimationManager(object):
 
         self.image.set_color(color)
 
+    def bounds(self, dest, t=0):
+
+        # the region draw touches, or None when it covers the whole frame
+        x, y = dest
+        return Rect(x, y, self.image.width, self.image.height)
+
+    def is_static(self, t=0):
+
+        # whether drawing at t would repeat the previous draw exactly
+        return True
+
 
 class BlurManager(AnimationManager):
 
-    def __init__(self, image, amount=11, decay=16, horizontal=True):
+    def __init__(self, image, amount=11, decay=16, horizontal=True, spread=5):
 
         self.image = image
         self.amount = amount
         self.decay = decay
         self.horizontal = horizontal
+        self.spread = spread
+
+        if amount not in image.blur_engines:
+            image.blur_engines[amount] = BlurEngine(image.mask, amount)
+
+        self.engine = image.blur_engines[amount]
+        self.drawn_jitter = None
 
-        self.faint_image = image.alpha_scale(2 / self.amount)
+        self._init_target()
+
+    def _init_target(self):
+
+        # the widest smear happens at t=0, so one surface of that size serves every frame
+        span = int(np.ptp(self._jitter(0)))
+
+        if self.horizontal:
+            self.smeared_surface = Surface((self.image.width + span, self.image.height)).convert_alpha()
+        else:
+            self.smeared_surface = Surface((self.image.width, self.image.height + span)).convert_alpha()
+
+        surfarray.pixels3d(self.smeared_surface)[:, :, :] = np.array(surfarray.pixels3d(self.image.surface)[0, 0])[None, None, :]
+        self.smeared = None
     
     def draw(self, surface, dest, t=0):
 
         x, y = dest
-        jitter = (5 * self.amount * np.exp(-self.decay * t) * np.linspace(-1, 1, self.amount)).astype(int)
+        jitter = self._jitter(t)
+        smeared = self.engine.smear(jitter, self.horizontal)
+        self.drawn_jitter = tuple(jitter)
+
+        if smeared is not self.smeared:
+            self.smeared = smeared
+            arr_alpha = surfarray.pixels_alpha(self.smeared_surface)
+            arr_alpha[:, :] = 0
+            arr_alpha[:smeared.shape[1], :smeared.shape[0]] = smeared.T
+            del arr_alpha
+
+        area = (0, 0, smeared.shape[1], smeared.shape[0])
 
         if self.horizontal:
-            surface.blits(zip(repeat(self.faint_image), zip(x + jitter, repeat(y))))
+            surface.blit(self.smeared_surface, (x + jitter.min(), y), area)
         else:
-            surface.blits(zip(repeat(self.faint_image), zip(repeat(x), y + jitter)))
+            surface.blit(self.smeared_surface, (x, y + jitter.min()), area)
     
     def set_color(self, color):
 
         super().set_color(color)
-        surfarray.pixels3d(self.faint_image)[:, :, :] = np.array(color)[None, None, :]
+        surfarray.pixels3d(self.smeared_surface)[:, :, :] = np.array(color)[None, None, :]
+
+    def bounds(self, dest, t=0):
+
+        x, y = dest
+        jitter = self._jitter(t)
+        span = int(np.ptp(jitter))
+
+        if self.horizontal:
+            return Rect(x + jitter.min(), y, self.image.width + span, self.image.height)
+        else:
+            return Rect(x, y + jitter.min(), self.image.width, self.image.height + span)
+
+    def is_static(self, t=0):
+
+        return tuple(self._jitter(t)) == self.drawn_jitter
+
+    def _jitter(self, t):
+
+        return (self.spread * self.amount * np.exp(-self.decay * t) * np.linspace(-1, 1, self.amount)).astype(int)
+
+
+# log transmittance is stored in fixed point with this many steps per unit
+LOG_TRANSMITTANCE_SCALE = 4096
+
+SMEAR_CACHE_BYTES = 32 * 2 ** 20
+
+
+class SmearCache(object):
+
+    # one least recently used cache for the smears of every image, bounded by bytes
+    def __init__(self, max_bytes=SMEAR_CACHE_BYTES):
+
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+
+        smeared = self.entries.get(key)
+
+        if smeared is not None:
+            self.entries.move_to_end(key)
+
+        return smeared
+
+    def put(self, key, smeared):
+
+        self.entries[key] = smeared
+        self.bytes += smeared.nbytes
+
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.nbytes
+
+
+smear_cache = SmearCache()
+
+
+class BlurEngine(object):
+
+    _ids = count()
+
+    def __init__(self, mask, amount, cache=None):
+
+        self.id = next(BlurEngine._ids)
+        self.mask = mask
+        self.amount = amount
+        self.shape = mask.shape
+        self.cache = cache if cache is not None else smear_cache
+        self.log_transmittance = None
+
+        # stacking faint copies composites to 1 - prod(1 - a_i), so summing the
+        # log transmittance of shifted copies gives the whole smear in one pass;
+        # both directions go through tables so that the sum stays in uint16
+        faint = np.minimum((2 / amount * np.arange(256)).astype(np.uint8), 254) / 255
+        steps = np.minimum(-np.log1p(-faint) * LOG_TRANSMITTANCE_SCALE, 65535 // amount)
+        self.to_log = np.round(steps).astype(np.uint16)
+        self.from_log = (-255 * np.expm1(-np.arange(amount * int(self.to_log.max()) + 1) / LOG_TRANSMITTANCE_SCALE)).astype(np.uint8)
+
+    def smear(self, jitter, horizontal=True):
+
+        offsets = jitter - jitter.min()
+        key = (self.id, tuple(offsets), horizontal)
+
+        smeared = self.cache.get(key)
+        if smeared is not None:
+            return smeared
+
+        # only images that are actually blurred pay for this
+        if self.log_transmittance is None:
+            self.log_transmittance = self.to_log[self.mask]
+
+        h, w = self.shape
+        span = int(offsets.max())
+
+        if span == 0:
+            total = self.log_transmittance * np.uint16(len(offsets))
+
+        elif horizontal:
+            total = np.zeros((h, w + span), dtype=np.uint16)
+            for offset in offsets:
+                total[:, offset:offset + w] += self.log_transmittance
+
+        else:
+            total = np.zeros((h + span, w), dtype=np.uint16)
+            for offset in offsets:
+                total[offset:offset + h, :] += self.log_transmittance
+
+        smeared = self.from_log[total]
+        self.cache.put(key, smeared)
+
+        return smeared
 
 
 class BlackoutWrapper(AnimationManager):
@@ -97,12 +257,13 @@ class BlackoutWrapper(AnimationManager):
     def __init__(self, animation_manager):
 
         self.animation_manager = animation_manager
+        self.drawn_alpha = None
     
     def draw(self, surface, dest, t=0):
 
         self.animation_manager.draw(surface, dest, t=t)
 
-        alpha = min(255, int(2550 * t))
+        alpha = self.drawn_alpha = self._alpha(t)
 
         blackout = surface.convert()
         blackout.fill((0, 0, 0))
@@ -114,6 +275,19 @@ class BlackoutWrapper(AnimationManager):
 
         self.animation_manager.set_color(color)
 
+    def bounds(self, dest, t=0):
+
+        return None
+
+    def is_static(self, t=0):
+
+        # once fully black nothing underneath shows through
+        return self.drawn_alpha == 255 and self._alpha(t) == 255
+
+    def _alpha(self, t):
+
+        return min(255, int(2550 * t))
+
 
 class InstantBlackout(AnimationManager):
 
@@ -129,6 +303,10 @@ class InstantBlackout(AnimationManager):
 
         pass
 
+    def bounds(self, dest, t=0):
+
+        return None
+
 
 class ColorChangeWrapper(AnimationManager):
 
@@ -163,4 +341,246 @@ class ColorChangeWrapper(AnimationManager):
     def set_color(self, color):
 
         self.animation_manager.set_color(color)
-        self.done = True
\ No newline at end of file
+        self.done = True
+
+    def bounds(self, dest, t=0):
+
+        if self.done:
+            return self.animation_manager.bounds(dest, t + self.t_delta)
+
+        return None
+
+    def is_static(self, t=0):
+
+        return self.done and self.animation_manager.is_static(t + self.t_delta)
+
+
+# one 16 bit lane per BGRA channel of a uint64, in the same order as the bytes on little-endian hosts
+LANES = np.uint64(0x0001000100010001)
+
+
+def pack_pixels(pixels):
+
+    # packs BGR pixels, or a single BGR color, as opaque BGRA lanes of a uint64
+    pixels = np.asarray(pixels, dtype=np.uint64)
+    return pixels[..., 0] | pixels[..., 1] << np.uint64(16) | pixels[..., 2] << np.uint64(32) | np.uint64(255) << np.uint64(48)
+
+
+def mask_bounds(mask):
+
+    # the smallest Rect holding every non-zero value of a mask
+    rows = np.flatnonzero(mask.any(1))
+    cols = np.flatnonzero(mask.any(0))
+
+    if len(rows) == 0:
+        return Rect(0, 0, 0, 0)
+
+    return Rect(int(cols[0]), int(rows[0]), int(cols[-1] + 1 - cols[0]), int(rows[-1] + 1 - rows[0]))
+
+
+class ArrayFrame(object):
+
+    # pixels are stored as BGRA bytes, which is what ffmpeg's rgb32 expects on little-endian hosts
+    def __init__(self, scale):
+
+        self.scale = self.width, self.height = scale
+
+        self.pixels = np.zeros((self.height, self.width, 4), dtype=np.uint8)
+        self.pixels[:, :, 3] = 255
+
+        # every pixel is opaque, so whole BGRA words can be written at once
+        self.words = self.pixels.view(np.uint32).reshape(self.height, self.width)
+
+        # flat scratch buffers, so that any leading part of them reshapes to a contiguous block
+        self._weight = np.empty(self.height * self.width, dtype=np.uint64)
+        self._tinted = np.empty(self.height * self.width, dtype=np.uint64)
+        self._blended = np.empty(self.height * self.width * 4, dtype=np.uint16)
+        self.clip = Rect(0, 0, self.width, self.height)
+
+    def get_data(self):
+
+        return self.pixels.data
+
+    def set_clip(self, rect=None):
+
+        if rect is None:
+            self.clip = Rect(0, 0, self.width, self.height)
+        else:
+            self.clip = Rect(rect).clip(Rect(0, 0, self.width, self.height))
+
+    def fill(self, color):
+
+        r, g, b = color
+        self.words[self._clip_index()] = b | g << 8 | r << 16 | 255 << 24
+
+    def darken(self, alpha):
+
+        # whole rows of BGRA bytes are scaled at once, and the alpha bytes reset afterwards
+        words = self.words[self._clip_index()]
+        region = self.pixels[self._clip_index()].reshape(words.shape[0], words.shape[1] * 4)
+        np.multiply(region, (255 - alpha) / 255, out=region, casting='unsafe')
+        np.bitwise_or(words, np.uint32(255 << 24), out=words)
+
+    def blit(self, source, dest, area=None):
+
+        # plain copy from another ArrayFrame, like blitting an opaque Surface; dest may be a Rect
+        x, y = dest[0], dest[1]
+        area = Rect(0, 0, source.width, source.height) if area is None else Rect(area)
+
+        clipped = self._clip((x, y), (area.height, area.width))
+        if clipped is None:
+            return
+
+        frame_index, (rows, cols) = clipped
+        self.pixels[frame_index] = source.pixels[area.y + rows.start:area.y + rows.stop, area.x + cols.start:area.x + cols.stop]
+
+    def _clip_index(self):
+
+        return slice(self.clip.top, self.clip.bottom), slice(self.clip.left, self.clip.right)
+
+    def blend_mask(self, mask, dest, color, bounds=None):
+
+        # bounds, when known, hold every non-zero value of the mask, so the margins are skipped
+        if bounds is not None:
+            mask = mask[bounds.top:bounds.bottom, bounds.left:bounds.right]
+            dest = (dest[0] + bounds.left, dest[1] + bounds.top)
+
+        self._blend(pack_pixels(tuple(color)[::-1]), mask, dest, mask.shape)
+
+    def blend(self, pixels, alpha, dest):
+
+        # pixels are packed once with pack_pixels, since they are usually blended every frame
+        self._blend(pixels, alpha, dest, pixels.shape)
+
+    def _clip(self, dest, shape):
+
+        x, y = dest
+        h, w = shape
+
+        x0, y0 = max(x, self.clip.left), max(y, self.clip.top)
+        x1, y1 = min(x + w, self.clip.right), min(y + h, self.clip.bottom)
+
+        if x1 <= x0 or y1 <= y0:
+            return None
+
+        return (slice(y0, y1), slice(x0, x1)), (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+
+    def _blend(self, source, alpha, dest, shape):
+
+        clipped = self._clip(dest, shape)
+        if clipped is None:
+            return
+
+        frame_index, source_index = clipped
+
+        # each row of the region is handled as one run of BGRA bytes; the source alpha is opaque,
+        # so the frame stays opaque
+        region = self.pixels[frame_index]
+        h, w = region.shape[:2]
+        region = region.reshape(h, w * 4)
+
+        if isinstance(source, np.ndarray):
+            source = source[source_index]
+
+        # out + ((source - out) * alpha >> 8) is exactly (out * (256 - alpha) + source * alpha) >> 8,
+        # whose terms never go negative or past 16 bits, so all four channels fit in uint64 lanes
+        if isinstance(alpha, np.ndarray):
+            weight = self._weight[:h * w].reshape(h, w)
+            np.copyto(weight, alpha[source_index])
+            tinted = np.multiply(weight, source, out=self._tinted[:h * w].reshape(h, w))
+            np.multiply(weight, LANES, out=weight)
+            np.subtract(np.uint64(256) * LANES, weight, out=weight)
+            weight = weight.view(np.uint16)
+        else:
+            tinted = np.multiply(source, np.uint64(alpha))
+            weight = 256 - alpha
+
+        blended = self._blended[:h * w * 4].reshape(h, w * 4)
+        np.multiply(region, weight, out=blended, dtype=np.uint16)
+        np.add(blended, tinted.view(np.uint16), out=blended)
+        np.right_shift(blended, 8, out=blended)
+        np.copyto(region, blended, casting='unsafe')
+
+
+class ArrayImage(object):
+
+    def __init__(self, f=None, namehint=None, height=720, mask=None):
+
+        if mask is None:
+
+            if namehint is None:
+                loaded = image.load(f)
+            else:
+                loaded = image.load(f, namehint)
+
+            old_width = loaded.get_width()
+            old_height = loaded.get_height()
+
+            # if image is black with transparency, this will safely convert to black and white
+            rgb = surfarray.array3d(loaded).astype(np.uint16)
+            alpha = surfarray.array_alpha(loaded).astype(np.uint16)[:, :, None]
+            surface = surfarray.make_surface(((rgb * alpha + 255 * (255 - alpha)) // 255).astype(np.uint8))
+
+            self.width = int(old_width * height / old_height)
+            self.height = height
+            if old_height < height:
+                surface = transform.scale(transform.scale2x(surface), (self.width, self.height))
+            else:
+                surface = transform.scale(surface, (self.width, self.height))
+
+            # the mask is the inverted average of rgb, stored row-major to match ArrayFrame
+            mask = np.ascontiguousarray(((765 - surfarray.array3d(surface).sum(2)) // 3).astype(np.uint8).T)
+
+        # the mask is only ever read, so it may be a read-only view of a shared cache
+        self.height, self.width = mask.shape
+        self.mask = mask
+        self.bounds = mask_bounds(mask)
+        self.color = (0, 0, 0)
+        self.blur_engines = {}
+
+    def set_color(self, color):
+
+        self.color = tuple(color)
+
+
+class ArrayAnimationManager(AnimationManager):
+
+    def draw(self, frame, dest, t=0):
+
+        frame.blend_mask(self.image.mask, dest, self.image.color, self.image.bounds)
+
+
+class ArrayBlurManager(BlurManager):
+
+    def _init_target(self):
+
+        pass
+
+    def draw(self, frame, dest, t=0):
+
+        x, y = dest
+        jitter = self._jitter(t)
+        smeared = self.engine.smear(jitter, self.horizontal)
+        self.drawn_jitter = tuple(jitter)
+
+        # the smear only reaches as far as the image's bounds stretched by the jitter
+        span = int(jitter.max() - jitter.min())
+        bounds = self.image.bounds
+
+        if self.horizontal:
+            frame.blend_mask(smeared, (x + jitter.min(), y), self.image.color, Rect(bounds.x, bounds.y, bounds.w + span, bounds.h))
+        else:
+            frame.blend_mask(smeared, (x, y + jitter.min()), self.image.color, Rect(bounds.x, bounds.y, bounds.w, bounds.h + span))
+
+    def set_color(self, color):
+
+        self.image.set_color(color)
+
+
+class ArrayBlackoutWrapper(BlackoutWrapper):
+
+    def draw(self, frame, dest, t=0):
+
+        self.animation_manager.draw(frame, dest, t=t)
+        self.drawn_alpha = self._alpha(t)
+        frame.darken(self.drawn_alpha)
@@ -4,19 +4,28 @@ import sys
 
 from pygame import image, surfarray
 
+from cache import file_digest
+
 try:
     from plumbum.cmd import ffmpeg
 except ImportError:
     raise ImportError('Cannot connect to ffmpeg. Are plumbum and ffmpeg installed?')
 
+# files at least this long (in seconds) are timed from their header instead of being decoded
+HEADER_DURATION_MIN = 600
+
 class FFmpegWriter(object):
 
-    def __init__(self, loop_filename, buildup_filename=None, scale=(1280, 720), frame_rate='24000/1001'):
+    def __init__(self, loop_filename, buildup_filename=None, scale=(1280, 720), frame_rate='24000/1001', output_filename='out.flv', threads=None, preset='veryfast', crf=22):
 
         self.loop_filename = loop_filename
         self.buildup_filename = buildup_filename
         self.scale = scale
         self.frame_rate = frame_rate
+        self.output_filename = output_filename
+        self.threads = threads
+        self.preset = preset
+        self.crf = crf
 
         self.popen = ffmpeg[self._generate_ffmpeg_options()].popen() #stderr=sys.stderr)
     
@@ -61,22 +70,63 @@ class FFmpegWriter(object):
             '-map', '[aout]',
             '-shortest',
             '-c:v', 'libx264',
-            '-preset', 'veryfast',
-            '-crf', 22,
+            '-preset', self.preset,
+            '-crf', self.crf,
             '-c:a', 'aac',
             '-b:a', '160k',
             '-ac', 2,
             '-ar', 44100,
             '-f', 'flv',
-            '-y', 'out.flv'
+            '-y', self.output_filename
         ]
 
+        if self.threads is not None:
+            output_settings = ['-threads', self.threads] + output_settings
+
         settings = video_input_settings + filter_settings + output_settings
 
         return settings
 
 
-def get_duration(filename):
+def open_audio_stream(filename, sample_rate=22050, start=0.0):
+
+    # mono float32 samples on stdout; stderr is kept quiet so that it never fills up and blocks
+    return ffmpeg[
+        '-loglevel', 'error',
+        '-nostats',
+        '-ss', '%.6f' % start,
+        '-i', filename,
+        '-f', 'f32le',
+        '-ac', 1,
+        '-ar', sample_rate,
+        '-'
+    ].popen()
+
+
+def probe_duration(filename):
+
+    # ffmpeg prints the container's duration before complaining that there is no output
+    exit_code, stdout, stderr = ffmpeg.run(['-i', filename], retcode=None)
+
+    m = re.search(r'Duration: (\d\d):(\d\d):(\d\d)\.(\d\d)', stderr)
+
+    if m is not None:
+        hours, minutes, seconds, fracs = [int(x) for x in m.groups()]
+        return hours * 3600 + minutes * 60 + seconds + fracs / 100
+
+    return None
+
+
+def get_duration(filename, cache=None):
+
+    # finding the duration may decode the whole file, so it is worth caching by content
+    if cache is not None:
+        return cache.get_object('duration-%s' % file_digest(filename), lambda: get_duration(filename))
+
+    # the header may only estimate the duration, which is close enough for long files but not for short loops
+    duration = probe_duration(filename)
+    if duration is not None and duration >= HEADER_DURATION_MIN:
+        return duration
 
     exit_code, stdout, stderr = ffmpeg.run(['-i', filename, '-f', 'null', '-'])
 
@@ -0,0 +1,268 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+from tempfile import mkdtemp, TemporaryDirectory
+import time
+import wave
+from zipfile import ZipFile
+
+import numpy as np
+
+import pygame
+from pygame import image, surfarray
+
+import hud
+from py0x40 import Hues0x40
+from respack import Resources
+from timing import StageTimer
+
+GOLDEN_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden_frames.json')
+BASELINE_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden_baseline.json')
+
+# frames are drawn with pygame's own font, which every install has, rather than the bundled pixel font
+GOLDEN_FONT = os.path.join(os.path.dirname(pygame.__file__), pygame.font.get_default_font())
+
+SYNTHETIC_SONG = 'loop_Synthetic'
+SYNTHETIC_BUILDUP = 'build_Synthetic'
+SYNTHETIC_RHYTHM = 'x...o...-...:...+...|...~...=...x.o.x.o.-.-.:.:.o...'
+SYNTHETIC_BUILDUP_RHYTHM = 'x...o...x...o.o.'
+
+INFO_XML = '''<info>
+    <name>Synthetic</name>
+    <author>py0x40</author>
+    <description>Generated respack for golden-frame checks</description>
+    <link>https://github.com/acadiansith/py0x40</link>
+</info>
+'''
+
+IMAGES_XML = '''<images>
+    <image name="circle"><align>center</align></image>
+    <image name="stripes"><align>left</align></image>
+    <image name="gradient"><align>right</align></image>
+</images>
+'''
+
+SONGS_XML = '''<songs>
+    <song name="%s">
+        <rhythm>%s</rhythm>
+        <buildup>%s</buildup>
+        <buildupRhythm>%s</buildupRhythm>
+    </song>
+</songs>
+''' % (SYNTHETIC_SONG, SYNTHETIC_RHYTHM, SYNTHETIC_BUILDUP, SYNTHETIC_BUILDUP_RHYTHM)
+
+
+class HashingWriter(object):
+
+    def __init__(self):
+
+        self.hashes = []
+
+    def write_frame(self, bytes):
+
+        self.hashes.append(hashlib.sha1(bytes).hexdigest())
+
+    def close(self):
+
+        pass
+
+
+def _synthetic_images(size=360):
+
+    ys, xs = np.mgrid[0:size, 0:size]
+
+    circle = np.where((xs - size / 2) ** 2 + (ys - size / 2) ** 2 < (size / 3) ** 2, 0, 255)
+    stripes = np.where((xs // 24 + ys // 48) % 2 == 0, 0, 255)
+    gradient = 255 * xs // (size - 1)
+
+    for name, gray in [('circle', circle), ('stripes', stripes), ('gradient', gradient)]:
+        yield name, np.repeat(gray.T[:, :, None], 3, axis=2).astype(np.uint8)
+
+
+def _write_tone(filename, seconds, beats, frequency, sample_rate=22050):
+
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    envelope = np.exp(-12 * ((t * beats / seconds) % 1.0))
+    samples = (0.5 * envelope * np.sin(2 * np.pi * frequency * t) * 32767).astype(np.int16)
+
+    with wave.open(filename, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.tobytes())
+
+
+def build_synthetic_respack(directory=None):
+
+    if directory is None:
+        directory = mkdtemp()
+
+    filename = os.path.join(directory, 'Synthetic.zip')
+
+    with ZipFile(filename, 'w') as zf:
+
+        zf.writestr('Synthetic/info.xml', INFO_XML)
+        zf.writestr('Synthetic/images.xml', IMAGES_XML)
+        zf.writestr('Synthetic/songs.xml', SONGS_XML)
+
+        for name, pixels in _synthetic_images():
+            image_filename = os.path.join(directory, name + '.png')
+            image.save(surfarray.make_surface(pixels), image_filename)
+            zf.write(image_filename, 'Synthetic/Images/%s.png' % name)
+
+        for name, seconds, beats, frequency in [(SYNTHETIC_SONG, 8.0, len(SYNTHETIC_RHYTHM), 220.0), (SYNTHETIC_BUILDUP, 2.0, len(SYNTHETIC_BUILDUP_RHYTHM), 330.0)]:
+            audio_filename = os.path.join(directory, name + '.wav')
+            _write_tone(audio_filename, seconds, beats, frequency)
+            zf.write(audio_filename, 'Synthetic/Songs/%s.wav' % name)
+
+    return filename
+
+
+def library_versions():
+
+    import librosa
+
+    return {'numpy': np.__version__, 'pygame': pygame.version.ver, 'librosa': librosa.__version__}
+
+
+def render(respack_filename, backend='pygame', scale=(320, 180), fps=12, seconds=12.0, seed=0, incremental=True):
+
+    writer = HashingWriter()
+    timer = StageTimer()
+
+    hud.set_font(GOLDEN_FONT)
+
+    hues = Hues0x40(
+        scale=scale,
+        fps=fps,
+        song=SYNTHETIC_SONG,
+        resources=Resources([respack_filename]),
+        backend=backend,
+        incremental=incremental,
+        rng=np.random.RandomState(seed),
+        writer=writer,
+        timer=timer,
+        verbose=False
+    )
+
+    start_t = time.perf_counter()
+    hues.play(seconds)
+    elapsed = time.perf_counter() - start_t
+    hues.close()
+
+    frames = max(1, len(writer.hashes))
+
+    return {
+        'hashes': writer.hashes,
+        'fps': len(writer.hashes) / elapsed if elapsed > 0 else 0.0,
+        'stages': dict((name, total / frames) for name, total in timer.stages.items())
+    }
+
+
+def compare_hashes(expected, actual):
+
+    mismatches = [i for i, (a, b) in enumerate(zip(expected, actual)) if a != b]
+
+    if len(expected) != len(actual):
+        return ['expected %d frames, rendered %d' % (len(expected), len(actual))]
+
+    if mismatches:
+        return ['%d of %d frames differ, first at frame %d' % (len(mismatches), len(expected), mismatches[0])]
+
+    return []
+
+
+def compare_throughput(baseline, result, threshold):
+
+    floor = baseline['fps'] * (1 - threshold)
+
+    if result['fps'] < floor:
+        return ['throughput %.1f fps is below %.1f fps (baseline %.1f fps, threshold %d%%)' % (result['fps'], floor, baseline['fps'], 100 * threshold)]
+
+    return []
+
+
+def _load(filename):
+
+    if not os.path.exists(filename):
+        return {}
+
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def _save(filename, data):
+
+    with open(filename, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Check rendered frames against golden hashes and a throughput baseline.')
+    parser.add_argument('--backend', default='numpy', choices=['pygame', 'numpy'])
+    parser.add_argument('--resolution', default='320x180')
+    parser.add_argument('--fps', type=float, default=12)
+    parser.add_argument('--seconds', type=float, default=12.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--golden', default=GOLDEN_FILENAME, help='file of stored frame hashes (default: next to this script)')
+    parser.add_argument('--baseline', default=BASELINE_FILENAME, help='file of throughput baselines for this machine (default: next to this script)')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed fractional drop in frames/s against the baseline')
+    parser.add_argument('--update-golden', action='store_true', help='store this run as the golden hashes')
+    parser.add_argument('--update-baseline', action='store_true', help='store this run as the throughput baseline')
+    args = parser.parse_args(argv)
+
+    width, height = [int(x) for x in args.resolution.lower().split('x')]
+
+    key = '%s-%dx%d-%gfps-%gs-seed%d' % (args.backend, width, height, args.fps, args.seconds, args.seed)
+
+    with TemporaryDirectory() as directory:
+
+        respack_filename = build_synthetic_respack(directory)
+
+        # incremental compositing must reproduce a full redraw exactly, so both are rendered
+        result = render(respack_filename, backend=args.backend, scale=(width, height), fps=args.fps, seconds=args.seconds, seed=args.seed, incremental=True)
+        full_result = render(respack_filename, backend=args.backend, scale=(width, height), fps=args.fps, seconds=args.seconds, seed=args.seed, incremental=False)
+
+    print('%s: %d frames at %.1f fps (%.1f fps with full redraws)' % (key, len(result['hashes']), result['fps'], full_result['fps']))
+    for name, elapsed in result['stages'].items():
+        print('  %-8s %.3f ms/frame' % (name, 1000 * elapsed))
+
+    failures = ['incremental against full redraw: %s' % failure for failure in compare_hashes(full_result['hashes'], result['hashes'])]
+
+    golden = _load(args.golden)
+    versions = library_versions()
+
+    if args.update_golden:
+        golden[key] = {'hashes': result['hashes'], 'versions': versions}
+        _save(args.golden, golden)
+
+    elif key in golden:
+        mismatches = compare_hashes(golden[key]['hashes'], result['hashes'])
+        failures += mismatches
+
+        if mismatches and golden[key]['versions'] != versions:
+            print('note: goldens were recorded with %s, this run uses %s' % (golden[key]['versions'], versions))
+
+    else:
+        failures.append('no golden hashes for %s in %s' % (key, args.golden))
+
+    # throughput depends on the machine, so baselines are recorded locally rather than committed
+    baselines = _load(args.baseline)
+    if args.update_baseline:
+        baselines[key] = {'fps': result['fps'], 'stages': result['stages']}
+        _save(args.baseline, baselines)
+    elif key in baselines:
+        failures += compare_throughput(baselines[key], result, args.threshold)
+
+    for failure in failures:
+        print('FAIL: %s' % failure)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+
+    sys.exit(main())
@@ -3,15 +3,35 @@ import os
 
 import numpy as np
 
-from pygame import draw, freetype, gfxdraw, Surface, surfarray, transform
+from pygame import draw, freetype, gfxdraw, SRCALPHA, Surface, surfarray, transform
 
+from draw import pack_pixels
 from ffmpeg import get_duration
+from spectrogram import load_spectrogram, StreamingSpectrogram
 
-import librosa
+FONT_FILENAME = os.path.join(os.path.dirname(__file__), 'fonts', 'PetMe128.ttf')
 
-freetype.init()
-font = freetype.Font(os.path.join(os.path.dirname(__file__), 'fonts', 'PetMe128.ttf'), size=10)
-_, _, _, MAX_HEIGHT_10 = font.get_rect('xo-+¤|:*XO)(~=iIsSvV#@', size=10)
+_font = None
+
+def get_font():
+
+    global _font
+
+    # loaded on first use so that importing hud stays cheap
+    if _font is None:
+        freetype.init()
+        _font = freetype.Font(FONT_FILENAME, size=10)
+
+    return _font
+
+def set_font(filename):
+
+    global FONT_FILENAME, _font
+
+    FONT_FILENAME = filename
+    _font = None
+
+RHYTHM_CHARS = 'xo-+¤|:*XO)(~=iIsSvV#@'
 
 BOX_BORDER_COLOR = (0x33, 0x33, 0x33)
 BOX_BACK_COLOR = (0xcc, 0xcc, 0xcc)
@@ -27,24 +47,56 @@ SPECTROGRAM_COLOR_0 = (20, 20, 20)
 SPECTROGRAM_COLOR_1 = (255, 255, 255)
 SPECTROGRAM_ALPHA = (155, 155, 155)
 
+# audio at least this long (in seconds) is analysed incrementally instead of all at once
+STREAMING_MIN_DURATION = 600
+
 class BeatBar(object):
 
-    def __init__(self, loop_rhythm, buildup_rhythm='', scale=(1000, 38), border_width=4):
+    def __init__(self, loop_rhythm, buildup_rhythm='', scale=(1000, 38), border_width=4, text_size=10, symbol_size=18):
 
         self.loop_rhythm = loop_rhythm
         self.buildup_rhythm = buildup_rhythm
 
         self.scale = self.width, self.height = scale
         self.border_width = border_width
+        self.text_size = text_size
+        self.symbol_size = symbol_size
+
+        _, _, _, self.text_height = get_font().get_rect(RHYTHM_CHARS, size=text_size)
+        self.scroll_width = (self.width - self.height) // 2 - self.border_width - 2
+        self.drawn_key = None
     
     def draw(self, surface, dest, j_raw=0, buildup=False):
 
+        self.drawn_key = (int(j_raw), buildup)
+
         self._draw_box(surface, dest)
         self._draw_circle(surface, dest)
 
         x, y = dest
 
-        j = int(j_raw)
+        this_char, scroll_chars, y_off = self._rhythm_text(int(j_raw), buildup)
+
+        if this_char != '.':
+            _, _, w, h = get_font().get_rect(this_char, size=self.symbol_size)
+            get_font().render_to(surface, (x + 0.5 + (self.width - w) / 2, y + 0.5 + (self.height - h) / 2), None, TEXT_COLOR, size=self.symbol_size)
+
+        scroll_surface = Surface((self.scroll_width, self.text_height)).convert_alpha()
+        scroll_surface.fill((0, 0, 0))
+        get_font().render_to(scroll_surface, (0, self.text_height - y_off), None, TEXT_COLOR, size=self.text_size)
+        alphas = surfarray.pixels3d(scroll_surface)[:, :, :3].sum(2) // 3
+        scroll_surface.fill(TEXT_COLOR)
+        surfarray.pixels_alpha(scroll_surface)[:, :] = alphas
+        
+        surface.blit(scroll_surface, (x + self.border_width + self.scroll_width + self.height + 2, y + (self.height - self.text_height) // 2))
+        surface.blit(transform.flip(scroll_surface, True, False), (x + self.border_width, y + (self.height - self.text_height) // 2))
+
+    def is_static(self, j_raw=0, buildup=False):
+
+        # the bar only changes when the beat does
+        return (int(j_raw), buildup) == self.drawn_key
+
+    def _rhythm_text(self, j, buildup=False):
 
         if buildup:
             this_char = self.buildup_rhythm[j]
@@ -53,32 +105,18 @@ class BeatBar(object):
             this_char = self.loop_rhythm[j]
             next_sequence_generator = lambda: chain(self.loop_rhythm[j+1:], cycle(self.loop_rhythm))
 
-        if this_char != '.':
-            _, _, w, h = font.get_rect(this_char, size=18)
-            font.render_to(surface, (x + 0.5 + (self.width - w) / 2, y + 0.5 + (self.height - h) / 2), None, TEXT_COLOR, size=18)
-        
-        scroll_width = (self.width - self.height) // 2 - self.border_width - 2
-
         n_chars = 40
         while True:
 
             scroll_chars = ''.join(islice(next_sequence_generator(), n_chars))
-            x_off, y_off, w, h = font.get_rect(scroll_chars)
+            x_off, y_off, w, h = get_font().get_rect(scroll_chars, size=self.text_size)
 
-            if w >= scroll_width:
+            if w >= self.scroll_width:
                 break
 
             n_chars *= 2
 
-        scroll_surface = Surface((scroll_width, MAX_HEIGHT_10)).convert_alpha()
-        scroll_surface.fill((0, 0, 0))
-        font.render_to(scroll_surface, (0, MAX_HEIGHT_10 - y_off), None, TEXT_COLOR)
-        alphas = surfarray.pixels3d(scroll_surface)[:, :, :3].sum(2) // 3
-        scroll_surface.fill(TEXT_COLOR)
-        surfarray.pixels_alpha(scroll_surface)[:, :] = alphas
-        
-        surface.blit(scroll_surface, (x + self.border_width + scroll_width + self.height + 2, y + (self.height - MAX_HEIGHT_10) // 2))
-        surface.blit(transform.flip(scroll_surface, True, False), (x + self.border_width, y + (self.height - MAX_HEIGHT_10) // 2))
+        return this_char, scroll_chars, y_off
 
     def _draw_box(self, surface, dest):
 
@@ -122,26 +160,57 @@ class InfoBox(object):
 
 class SpectrumVisualizer(object):
 
-    def __init__(self, loop_filename, buildup_filename=None, scale=(1000, 80), n_mels=512, rects=True):
+    def __init__(self, loop_filename, buildup_filename=None, scale=(1000, 80), n_mels=512, rects=True, cache=None, loop_duration=None, buildup_duration=None, streaming=None):
 
         self.scale = self.width, self.height = scale
 
-        self.loop, sr = librosa.load(loop_filename, mono=True)
-        self.loop_spectrogram = np.maximum(0, -5 + librosa.power_to_db(librosa.feature.melspectrogram(self.loop, sr=sr, n_fft=8192, hop_length=512, n_mels=n_mels)))
-        self.loop_duration = get_duration(loop_filename)
-        self.power_max = np.max(self.loop_spectrogram)
+        self.n_mels = n_mels
+        self.rects = rects
+
+        self.static_power_max = 0.0
+        self.streams = []
+
+        self.loop_duration = loop_duration if loop_duration is not None else get_duration(loop_filename)
+        self.loop_spectrogram = self._load_spectrogram(loop_filename, self.loop_duration, 8192, cache, streaming, loop=True)
 
         if buildup_filename is not None:
-            self.buildup, sr = librosa.load(buildup_filename, mono=True)
-            self.buildup_spectrogram = np.maximum(0, -5 + librosa.power_to_db(librosa.feature.melspectrogram(self.buildup, sr=sr, n_fft=4096, hop_length=512, n_mels=n_mels)))
-            self.buildup_duration = get_duration(buildup_filename)
-            self.power_max = max(self.power_max, np.max(self.loop_spectrogram))
+            self.buildup_duration = buildup_duration if buildup_duration is not None else get_duration(buildup_filename)
+            self.buildup_spectrogram = self._load_spectrogram(buildup_filename, self.buildup_duration, 4096, cache, streaming, loop=False)
         else:
             # self.buildup_spectrogram = None
             self.buildup_duration = None
-        
-        self.n_mels = n_mels
-        self.rects = rects
+
+    @property
+    def power_max(self):
+
+        return max([self.static_power_max] + [stream.power_max for stream in self.streams]) or 1.0
+
+    def close(self):
+
+        # every stream is stopped even if one of them failed
+        errors = []
+        for stream in self.streams:
+            try:
+                stream.close()
+            except RuntimeError as e:
+                errors.append(e)
+
+        if errors:
+            raise errors[0]
+
+    def _load_spectrogram(self, filename, duration, n_fft, cache, streaming, loop):
+
+        if streaming is None:
+            streaming = duration >= STREAMING_MIN_DURATION
+
+        if streaming:
+            stream = StreamingSpectrogram(filename, duration, n_fft=n_fft, n_mels=self.n_mels, loop=loop)
+            self.streams.append(stream)
+            return stream
+
+        spectrogram = load_spectrogram(filename, n_fft=n_fft, n_mels=self.n_mels, cache=cache)
+        self.static_power_max = max(self.static_power_max, np.max(spectrogram))
+        return spectrogram
 
     def draw(self, surface, dest, t=0, buildup=False):
 
@@ -156,6 +225,9 @@ class SpectrumVisualizer(object):
         
         j = int(t * spectrogram.shape[1] / duration)
 
+        # power_max looks at every stream, so it is read once per frame
+        power_max = self.power_max
+
         spectrum_surface = Surface((self.width // 2, self.height)).convert_alpha()
         spectrum_surface.fill((0, 0, 0))
 
@@ -163,12 +235,12 @@ class SpectrumVisualizer(object):
 
             for x_off, power in zip(np.linspace(0, self.width // 2, self.n_mels + 1)[:-1], spectrogram[:, j]):
 
-                gfxdraw.rectangle(spectrum_surface, (x_off, self.height * (1 - power / self.power_max), self.width // 2 / self.n_mels, self.height), SPECTROGRAM_ALPHA)
+                gfxdraw.rectangle(spectrum_surface, (x_off, self.height * (1 - power / power_max), self.width // 2 / self.n_mels, self.height), SPECTROGRAM_ALPHA)
 
         else:
 
             points = [(0, self.height)] + [
-                (x_off, self.height * (1 - power/self.power_max)) for x_off, power in zip(np.linspace(0, self.width // 2, self.n_mels + 2)[1:-1], spectrogram[:, j])
+                (x_off, self.height * (1 - power/power_max)) for x_off, power in zip(np.linspace(0, self.width // 2, self.n_mels + 2)[1:-1], spectrogram[:, j])
                 ] + [(self.width // 2, self.height)]
 
             gfxdraw.aapolygon(spectrum_surface, points, SPECTROGRAM_ALPHA)
@@ -185,3 +257,121 @@ class SpectrumVisualizer(object):
 
         surface.blit(spectrum_surface, (x + self.width // 2, y))
         surface.blit(transform.flip(spectrum_surface, True, False), dest)
+
+
+def _bgr(color):
+
+    return np.array(color[::-1], dtype=np.uint8)
+
+
+def _text_mask(text, size):
+
+    if text == '':
+        return np.zeros((0, 0), dtype=np.uint8)
+
+    raw, (w, h) = get_font().render_raw(text, size=size)
+    return np.frombuffer(raw, dtype=np.uint8).reshape(h, w)
+
+
+class ArrayBeatBar(BeatBar):
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+
+        inner = (slice(self.border_width, self.height - self.border_width), slice(self.border_width, self.width - self.border_width))
+        bar_height = 2 * (self.height - 2 * self.border_width) // 3
+        bar_y = (self.height - bar_height) // 2
+
+        box = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        box[:, :] = _bgr(BOX_BORDER_COLOR)
+        box[inner] = _bgr(BOX_BACK_COLOR)
+        box[bar_y:bar_y + bar_height, self.border_width:self.width - self.border_width] = _bgr(BOX_BAR_COLOR)
+        self.box = pack_pixels(box)
+
+        circle = Surface((self.height, self.height), SRCALPHA, 32)
+        self._draw_circle(circle, (self.height // 2 - self.width // 2, 0))
+        self.circle = pack_pixels(surfarray.array3d(circle)[:, :, ::-1].transpose(1, 0, 2))
+        self.circle_alpha = np.ascontiguousarray(surfarray.array_alpha(circle).T)
+
+        self.symbol_masks = {}
+        self.scroll_mask = np.zeros((self.text_height, self.scroll_width), dtype=np.uint8)
+        self.scroll_key = None
+
+    def draw(self, frame, dest, j_raw=0, buildup=False):
+
+        x, y = dest
+        j = int(j_raw)
+        self.drawn_key = (j, buildup)
+
+        frame.blend(self.box, BOX_ALPHA, dest)
+        frame.blend(self.circle, self.circle_alpha, (x + self.width // 2 - self.height // 2, y))
+
+        # the rendered text only changes when the beat does
+        if self.scroll_key != (j, buildup):
+            self.scroll_key = (j, buildup)
+            self.this_char, scroll_chars, y_off = self._rhythm_text(j, buildup)
+
+            text = _text_mask(scroll_chars, self.text_size)
+            top = max(0, self.text_height - y_off)
+            h = min(self.text_height - top, text.shape[0])
+            w = min(self.scroll_width, text.shape[1])
+
+            self.scroll_mask[:, :] = 0
+            self.scroll_mask[top:top + h, :w] = text[:h, :w]
+
+        if self.this_char != '.':
+
+            if self.this_char not in self.symbol_masks:
+                self.symbol_masks[self.this_char] = _text_mask(self.this_char, self.symbol_size)
+
+            symbol = self.symbol_masks[self.this_char]
+            h, w = symbol.shape
+            frame.blend_mask(symbol, (x + (self.width - w) // 2, y + (self.height - h) // 2), TEXT_COLOR)
+
+        scroll_y = y + (self.height - self.text_height) // 2
+        frame.blend_mask(self.scroll_mask, (x + self.border_width + self.scroll_width + self.height + 2, scroll_y), TEXT_COLOR)
+        frame.blend_mask(self.scroll_mask[:, ::-1], (x + self.border_width, scroll_y), TEXT_COLOR)
+
+
+class ArraySpectrumVisualizer(SpectrumVisualizer):
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+
+        half_width = self.width // 2
+
+        ts = (np.arange(self.height) / (self.height - 1))[:, None]
+        gradient = (np.array(SPECTROGRAM_COLOR_0[::-1])[None, :] * ts + np.array(SPECTROGRAM_COLOR_1[::-1])[None, :] * (1 - ts)).astype(np.uint8)
+        self.gradient = pack_pixels(np.broadcast_to(gradient[:, None, :], (self.height, half_width, 3)))
+
+        # first mel bin shown in each pixel column; columns covering several bins show their maximum
+        self.bin_starts = (np.arange(half_width) * self.n_mels) // half_width
+        self.rows = np.arange(self.height)[:, None]
+        self.tops = np.empty(half_width, dtype=self.loop_spectrogram.dtype)
+        self.filled = np.empty((self.height, half_width), dtype=bool)
+        self.alpha = np.empty((self.height, half_width), dtype=np.uint8)
+
+    def draw(self, frame, dest, t=0, buildup=False):
+
+        x, y = dest
+
+        if buildup:
+            spectrogram = self.buildup_spectrogram
+            duration = self.buildup_duration
+        else:
+            spectrogram = self.loop_spectrogram
+            duration = self.loop_duration
+
+        j = int(t * spectrogram.shape[1] / duration)
+
+        np.maximum.reduceat(spectrogram[:, j], self.bin_starts, out=self.tops)
+        np.multiply(self.tops, -self.height / self.power_max, out=self.tops)
+        np.add(self.tops, self.height, out=self.tops)
+
+        np.greater_equal(self.rows, self.tops[None, :], out=self.filled)
+        np.multiply(self.filled, SPECTROGRAM_ALPHA[0], out=self.alpha, casting='unsafe')
+
+        frame.blend(self.gradient, self.alpha, (x + self.width // 2, y))
+        frame.blend(self.gradient, self.alpha[:, ::-1], dest)
@@ -1,51 +1,176 @@
+import argparse
 from itertools import chain, count, islice
 import os
+import shutil
+from tempfile import mkdtemp
 import time
 import sys
 
+IMPORT_START = time.perf_counter()
+
 os.environ['SDL_VIDEODRIVER'] = 'dummy'
 
 import numpy as np
 
 import pygame
-from pygame import display, image, transform, draw, Surface, surfarray
+from pygame import display, image, transform, draw, Rect, Surface, surfarray
 
+from cache import FileCache
 from draw import Image, AnimationManager, BlurManager, BlackoutWrapper, ColorChangeWrapper, InstantBlackout
+from draw import ArrayFrame, ArrayImage, ArrayAnimationManager, ArrayBlurManager, ArrayBlackoutWrapper
 from ffmpeg import FFmpegWriter, get_duration
-from hud import BeatBar, SpectrumVisualizer
+from hud import BeatBar, SpectrumVisualizer, ArrayBeatBar, ArraySpectrumVisualizer
 from respack import Resources
-
-display.set_mode((1, 1), pygame.NOFRAME, 32)
+from timing import StageTimer
+
+_IMPORTS_DONE = time.perf_counter()
+_cold_start = True
+
+# all layers are laid out for this height and scaled to the output resolution
+BASE_HEIGHT = 720
+
+# the beat bar font is a pixel font drawn on an 8px grid and is unreadable below that
+MIN_FONT_SIZE = 8
+
+PROFILES = {
+    'full': {'scale': (1280, 720), 'fps': 24000/1001, 'preset': 'veryfast', 'crf': 22, 'min_realtime': None},
+    'draft': {'scale': (320, 180), 'fps': 12, 'preset': 'ultrafast', 'crf': 30, 'min_realtime': 10},
+}
+
+# the numpy backend composites into a preallocated array and never touches the display
+BACKENDS = {
+    'pygame': {
+        'image': Image,
+        'animation': AnimationManager,
+        'blur': BlurManager,
+        'blackout': BlackoutWrapper,
+        'beat_bar': BeatBar,
+        'spectrum': SpectrumVisualizer
+    },
+    'numpy': {
+        'image': ArrayImage,
+        'animation': ArrayAnimationManager,
+        'blur': ArrayBlurManager,
+        'blackout': ArrayBlackoutWrapper,
+        'beat_bar': ArrayBeatBar,
+        'spectrum': ArraySpectrumVisualizer
+    },
+}
+
+def init_display():
+
+    if display.get_surface() is None:
+        display.set_mode((1, 1), pygame.NOFRAME, 32)
 
 class Hues0x40(object):
 
-    def __init__(self, respack_filenames=None, scale=(1280, 720), fps=24000/1001):
+    def __init__(self, respack_filenames=None, scale=(1280, 720), fps=24000/1001, song='loop_LoveOnHaightStreet', output_filename='out.flv', resources=None, encoder_threads=None, cache=None, preset='veryfast', crf=22, backend='pygame', incremental=True, rng=None, writer=None, timer=None, telemetry=None, verbose=True):
 
-        self.resources = Resources(respack_filenames)
+        global _cold_start
 
-        self.scale = self.width, self.height = scale
-        self.fps = fps
+        # only the first renderer in a process pays for the imports
+        if _cold_start:
+            _cold_start = False
+            self.startup = StageTimer(start=IMPORT_START)
+            self.startup.add('imports', _IMPORTS_DONE - IMPORT_START)
+        else:
+            self.startup = StageTimer()
 
-        self.loop_filename, self.buildup_filename, self.song_info = self.resources.open_song('loop_LoveOnHaightStreet')
-        self.loop_rhythm = self.song_info.rhythm
-        self.loop_duration = get_duration(self.loop_filename)
+        self.backend_name = backend
+        self.backend = BACKENDS[backend]
+        self.incremental = incremental
 
-        if self.buildup_filename is not None:
-            self.buildup_rhythm = self.song_info.buildup_rhythm
-            self.buildup_duration = get_duration(self.buildup_filename)
-        else:
-            self.buildup_rhythm = ''
-            self.buildup_duration = 0.0
+        # every random choice goes through this, so a seeded rng makes renders reproducible
+        self.rng = rng if rng is not None else np.random.RandomState()
+        self.timer = timer if timer is not None else StageTimer()
+        self.telemetry = telemetry
+        self.verbose = verbose
 
-        self.writer = FFmpegWriter(self.loop_filename, self.buildup_filename, scale=self.scale, frame_rate=self.fps)
+        if backend == 'pygame':
+            with self.startup.stage('display'):
+                init_display()
 
-        self.beat_bar = BeatBar(self.loop_rhythm, buildup_rhythm=self.buildup_rhythm)
-        self.spectrum_visualizer = SpectrumVisualizer(self.loop_filename, self.buildup_filename)
+        if resources is None:
+            with self.startup.stage('respacks'):
+                resources = Resources(respack_filenames, cache=cache)
+
+        self.resources = resources
+
+        self.scale = self.width, self.height = scale
+        self.fps = fps
+        self.ui_scale = self.height / BASE_HEIGHT
+
+        # the song is extracted here and removed again on close
+        self.tempdir = mkdtemp()
+
+        own_writer = None
+
+        try:
+            with self.startup.stage('song'):
+                self.loop_filename, self.buildup_filename, self.song_info = self.resources.open_song(song, path=self.tempdir)
+
+            with self.startup.stage('durations'):
+                self.loop_rhythm = self.song_info.rhythm
+                self.loop_duration = get_duration(self.loop_filename, cache=cache)
+
+                if self.buildup_filename is not None:
+                    self.buildup_rhythm = self.song_info.buildup_rhythm
+                    self.buildup_duration = get_duration(self.buildup_filename, cache=cache)
+                else:
+                    self.buildup_rhythm = ''
+                    self.buildup_duration = 0.0
+
+            with self.startup.stage('encoder'):
+                if writer is None:
+                    writer = own_writer = FFmpegWriter(self.loop_filename, self.buildup_filename, scale=self.scale, frame_rate=self.fps, output_filename=output_filename, threads=encoder_threads, preset=preset, crf=crf)
+
+                self.writer = writer
+
+            with self.startup.stage('beat bar'):
+                self.beat_bar = self.backend['beat_bar'](
+                    self.loop_rhythm,
+                    buildup_rhythm=self.buildup_rhythm,
+                    scale=self._scaled((1000, 38)),
+                    border_width=max(1, self._scaled(4)),
+                    text_size=max(MIN_FONT_SIZE, self._scaled(10)),
+                    symbol_size=max(MIN_FONT_SIZE, self._scaled(18))
+                )
+
+            with self.startup.stage('spectrogram'):
+                spectrum_scale = self._scaled((1000, 80))
+                self.spectrum_visualizer = self.backend['spectrum'](
+                    self.loop_filename,
+                    self.buildup_filename,
+                    scale=spectrum_scale,
+                    n_mels=512 if self.height >= BASE_HEIGHT else min(512, spectrum_scale[0] // 2),
+                    cache=cache,
+                    loop_duration=self.loop_duration,
+                    buildup_duration=self.buildup_duration if self.buildup_filename is not None else None
+                )
+
+            self.bg = (255, 255, 255)
+            self.fg = (0, 0, 0)
+
+            with self.startup.stage('first image'):
+                self._pick_new_image()
+
+            self.animation_manager = self.backend['animation'](self.image)
+
+        except Exception:
+            # an encoder we started loops its audio forever unless killed
+            if own_writer is not None:
+                own_writer.popen.kill()
+                own_writer.popen.wait()
+
+            if getattr(self, 'spectrum_visualizer', None) is not None:
+                try:
+                    self.spectrum_visualizer.close()
+                except Exception:
+                    pass
+
+            shutil.rmtree(self.tempdir, ignore_errors=True)
+            raise
 
-        self.bg = (255, 255, 255)
-        self.fg = (0, 0, 0)
-        self._pick_new_image()
-        self.animation_manager = AnimationManager(self.image)
         self.i = None
         self.am_i = None
 
@@ -53,12 +178,20 @@ class Hues0x40(object):
     
     def play(self, seconds):
 
-        self.surface = Surface(self.scale)
+        # the scene holds background and animation; HUD layers are drawn over a copy of it
+        self.surface = self._new_frame()
+        self.scene = self._new_frame()
+        self.redraw = True
+        self.animation_bounds = None
 
         total_frames = int(seconds * self.fps)
+        first_frame_start = time.perf_counter()
 
         for frame in range(total_frames):
 
+            if self.telemetry is not None:
+                self.telemetry.frame_start()
+
             t = frame / self.fps
 
             if t < self.buildup_duration:
@@ -72,23 +205,32 @@ class Hues0x40(object):
                 self.duration = self.loop_duration
                 self.rhythm = self.loop_rhythm
 
-            j_raw = ((t / self.duration) % 1.0) * len(self.rhythm)
-            j = int(j_raw)
+            with self.timer.stage('beat'):
+                j_raw = ((t / self.duration) % 1.0) * len(self.rhythm)
+                j = int(j_raw)
+
+                self._set_beat(j)
+                beat_t = ((j_raw - self.am_i) % len(self.rhythm)) / len(self.rhythm) * self.duration
 
-            self._set_beat(j)
-            beat_t = ((j_raw - self.am_i) % len(self.rhythm)) / len(self.rhythm) * self.duration
+            self._compose(j_raw, beat_t, t)
 
-            self.surface.fill(self.bg)
-            self.animation_manager.draw(self.surface, self.dest, beat_t)
+            with self.timer.stage('encode'):
+                self.writer.write_frame(self._frame_data())
 
-            self.beat_bar.draw(self.surface, ((self.width - self.beat_bar.width) // 2, -4), j_raw, self.buildup)
-            self.spectrum_visualizer.draw(self.surface, ((self.width - self.beat_bar.width) // 2, self.height - self.spectrum_visualizer.height), t % self.loop_duration, buildup=self.buildup)
+            if frame == 0 and 'first frame' not in self.startup.stages:
+                self.startup.add('first frame', time.perf_counter() - first_frame_start)
+                self.startup.stop()
 
-            self.writer.write_frame(self.surface.get_buffer().raw)
+            if self.telemetry is not None:
+                self.telemetry.frame_end()
     
     def close(self):
 
-        self.writer.close()
+        try:
+            self.writer.close()
+            self.spectrum_visualizer.close()
+        finally:
+            shutil.rmtree(self.tempdir, ignore_errors=True)
     
     def _set_beat(self, j):
 
@@ -111,8 +253,61 @@ class Hues0x40(object):
                 changed = True
         
         if changed:
-            print('0x%04x' % self.i)
+            if self.verbose:
+                print('0x%04x' % self.i)
             self._set_anim(self.rhythm[self.i])
+            self.redraw = True
+
+    def _compose(self, j_raw, beat_t, t):
+
+        beat_bar_dest = ((self.width - self.beat_bar.width) // 2, -self.beat_bar.border_width)
+        spectrum_dest = ((self.width - self.beat_bar.width) // 2, self.height - self.spectrum_visualizer.height)
+        beat_bar_rect = Rect(beat_bar_dest, self.beat_bar.scale)
+        spectrum_rect = Rect(spectrum_dest, self.spectrum_visualizer.scale)
+
+        # work out which part of the scene changed since the last frame
+        if self.redraw or not self.incremental:
+            scene_dirty = Rect(0, 0, self.width, self.height)
+
+        elif self.animation_manager.is_static(beat_t):
+            scene_dirty = None
+
+        else:
+            bounds = self.animation_manager.bounds(self.dest, beat_t)
+
+            if bounds is None or self.animation_bounds is None:
+                scene_dirty = Rect(0, 0, self.width, self.height)
+            else:
+                scene_dirty = bounds.union(self.animation_bounds)
+
+        if scene_dirty is not None:
+            with self.timer.stage('scene'):
+                self.scene.set_clip(scene_dirty)
+                self.scene.fill(self.bg)
+                self.animation_manager.draw(self.scene, self.dest, beat_t)
+                self.scene.set_clip(None)
+                self.animation_bounds = self.animation_manager.bounds(self.dest, beat_t)
+
+        self.redraw = False
+
+        # restore everything that is about to be redrawn before drawing any HUD layer over it
+        redraw_beat_bar = not self.beat_bar.is_static(j_raw, self.buildup) or (scene_dirty is not None and scene_dirty.colliderect(beat_bar_rect))
+
+        restore = [spectrum_rect]
+        if scene_dirty is not None:
+            restore.append(scene_dirty)
+        if redraw_beat_bar:
+            restore.append(beat_bar_rect)
+
+        with self.timer.stage('restore'):
+            for rect in restore:
+                self.surface.blit(self.scene, rect, rect)
+
+        with self.timer.stage('hud'):
+            if redraw_beat_bar:
+                self.beat_bar.draw(self.surface, beat_bar_dest, j_raw, self.buildup)
+
+            self.spectrum_visualizer.draw(self.surface, spectrum_dest, t % self.loop_duration, buildup=self.buildup)
     
     def _set_anim(self, beat):
 
@@ -123,14 +318,14 @@ class Hues0x40(object):
             self._pick_new_colors()
             self._pick_new_image()
             self.am_i = self.i
-            self.animation_manager = BlurManager(self.image, horizontal=True)
+            self.animation_manager = self._blur_manager(horizontal=True)
         
         elif beat == 'x':
 
             self._pick_new_colors()
             self._pick_new_image()
             self.am_i = self.i
-            self.animation_manager = BlurManager(self.image, horizontal=False)
+            self.animation_manager = self._blur_manager(horizontal=False)
         
         elif beat == ':':
 
@@ -142,12 +337,12 @@ class Hues0x40(object):
             self._pick_new_colors()
             self._pick_new_image()
             self.am_i = self.i
-            self.animation_manager = AnimationManager(self.image)
+            self.animation_manager = self.backend['animation'](self.image)
 
         elif beat == '+':
 
             self.am_i = self.i
-            self.animation_manager = BlackoutWrapper(BlurManager(self.image, horizontal=True))
+            self.animation_manager = self.backend['blackout'](self._blur_manager(horizontal=True))
         
         elif beat == '|':
 
@@ -166,7 +361,7 @@ class Hues0x40(object):
             new_bg, new_fg = self._gen_new_colors()
             self.am_i = self.i
             duration = self.duration * self._get_beat_length(self.i) / len(self.rhythm)
-            self.animation_manager = ColorChangeWrapper(AnimationManager(self.image), self.bg, self.fg, new_bg, new_fg, duration)
+            self.animation_manager = ColorChangeWrapper(self.backend['animation'](self.image), self.bg, self.fg, new_bg, new_fg, duration)
 
         
     def _pick_new_colors(self):
@@ -176,13 +371,13 @@ class Hues0x40(object):
     
     def _gen_new_colors(self):
 
-        bg = tuple(np.random.randint(160, 256) for _ in range(3))
-        fg = tuple(np.random.randint(96) for _ in range(3))
+        bg = tuple(self.rng.randint(160, 256) for _ in range(3))
+        fg = tuple(self.rng.randint(96) for _ in range(3))
         return bg, fg
     
     def _pick_new_image(self):
 
-        self.image, self.image_info = self.resources.open_random_image()
+        self.image, self.image_info = self.resources.open_random_image(height=self.height, image_class=self.backend['image'], rng=self.rng)
         self.image.set_color(self.fg)
 
         if self.image_info.align == 'left':
@@ -194,6 +389,36 @@ class Hues0x40(object):
         else: # default to center
             self.dest = ((self.width - self.image.width) // 2, 0)
 
+    def _blur_manager(self, horizontal=True):
+
+        return self.backend['blur'](self.image, horizontal=horizontal, spread=5 * self.ui_scale)
+
+    def _new_frame(self):
+
+        if self.backend_name == 'numpy':
+            return ArrayFrame(self.scale)
+
+        return Surface(self.scale)
+
+    def _frame_data(self):
+
+        if self.backend_name == 'numpy':
+            return self.surface.get_data()
+
+        data = self.surface.get_buffer().raw
+
+        if self.telemetry is not None:
+            self.telemetry.record_allocation('frame buffer copy', len(data), kind='bytes')
+
+        return data
+
+    def _scaled(self, size):
+
+        if isinstance(size, tuple):
+            return tuple(self._scaled(s) for s in size)
+
+        return int(round(size * self.ui_scale))
+
     def _get_beat_length(self, i, buildup=False):
 
         if buildup:
@@ -211,12 +436,40 @@ class Hues0x40(object):
 
 if __name__ == '__main__':
 
-    seconds = 10
+    parser = argparse.ArgumentParser(description='Render a song to out.flv.')
+    parser.add_argument('profile', nargs='?', default='full', choices=sorted(PROFILES))
+    parser.add_argument('backend', nargs='?', default='pygame', choices=sorted(BACKENDS))
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--telemetry', default=None, help='append periodic allocation and memory reports to this file')
+    parser.add_argument('--telemetry-interval', type=float, default=60.0, help='seconds between telemetry reports')
+    parser.add_argument('--telemetry-sample-every', type=int, default=50, help='trace every Nth frame line by line to attribute transient allocations (0 to disable)')
+    args = parser.parse_args()
+
+    telemetry = None
+    if args.telemetry is not None:
+        import draw as draw_module, hud as hud_module
+        from telemetry import Telemetry
 
-    hues = Hues0x40()
+        telemetry = Telemetry(args.telemetry, interval=args.telemetry_interval, sample_every=args.telemetry_sample_every)
+        telemetry.start([draw_module, hud_module, sys.modules[__name__]])
+
+    profile = dict(PROFILES[args.profile])
+    min_realtime = profile.pop('min_realtime')
+
+    hues = Hues0x40(backend=args.backend, cache=FileCache(), telemetry=telemetry, **profile)
 
     start_t = time.time()
-    hues.play(seconds)
+    hues.play(args.seconds)
     hues.close()
-    print((time.time() - start_t) / seconds)
+    elapsed = time.time() - start_t
+
+    if telemetry is not None:
+        telemetry.close()
+
+    print(hues.startup.report('startup'))
+    print('%.1f fps, %.2fx realtime' % (args.seconds * hues.fps / elapsed, args.seconds / elapsed))
+
+    if min_realtime is not None and args.seconds / elapsed < min_realtime:
+        print('slower than the %s profile target of %gx realtime' % (args.profile, min_realtime))
+        sys.exit(1)
     
\ No newline at end of file
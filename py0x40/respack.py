@@ -1,3 +1,5 @@
+from collections import OrderedDict
+import hashlib
 from itertools import chain
 import os
 import random
@@ -5,6 +7,7 @@ from tempfile import mkdtemp
 from xml.etree import ElementTree
 from zipfile import ZipFile
 
+from cache import stat_digest
 from draw import Image
 
 audio_extensions = ['.mp3', '.ogg', '.wav']
@@ -13,33 +16,69 @@ image_extensions = ['.png', '.gif', '.jpg', '.jpeg']
 
 class Resources(object):
 
-    def __init__(self, filenames=None):
+    def __init__(self, filenames=None, respacks=None, image_cache_size=8, cache=None):
 
-        if filenames is None:
-            filenames = [os.path.join('respacks', fn) for fn in next(os.walk('respacks'))[2] if fn.endswith('.zip')]
+        if respacks is None:
 
-        self.respacks = [ResPack(fn) for fn in filenames]
+            if filenames is None:
+                filenames = [os.path.join('respacks', fn) for fn in next(os.walk('respacks'))[2] if fn.endswith('.zip')]
+
+            respacks = [load_respack(fn, cache=cache) for fn in filenames]
+
+        self.respacks = list(respacks)
 
         self.images = list(chain(*[respack.images for respack in self.respacks]))
         self.songs = list(chain(*[respack.songs for respack in self.respacks]))
+
+        # recently opened images are kept so that their blur caches survive between beats
+        self.image_cache = OrderedDict()
+        self.image_cache_size = image_cache_size
+        self.cache = cache
     
-    def open_random_image(self):
+    def open_random_image(self, height=720, image_class=Image, rng=None):
+
+        if rng is None:
+            name = random.choice(self.images)
+        else:
+            name = self.images[rng.randint(len(self.images))]
 
-        return self.open_image(random.choice(self.images))
+        return self.open_image(name, height=height, image_class=image_class)
 
-    def open_image(self, name):
+    def open_image(self, name, height=720, image_class=Image):
+
+        key = (name, height, image_class)
+
+        if key in self.image_cache:
+            self.image_cache.move_to_end(key)
+            return self.image_cache[key]
 
         for respack in self.respacks:
 
             if name in respack.images:
-                return respack.open_image(name)
 
-    def open_song(self, name):
+                self.image_cache[key] = respack.open_image(name, height=height, image_class=image_class, cache=self.cache)
+                while len(self.image_cache) > self.image_cache_size:
+                    self.image_cache.popitem(last=False)
+
+                return self.image_cache[key]
+
+    def open_song(self, name, path=None):
 
         for respack in self.respacks:
 
             if name in respack.songs:
-                return respack.open_song(name)
+                return respack.open_song(name, path=path)
+
+        raise ValueError('No song %s' % name)
+
+
+def load_respack(filename, cache=None):
+
+    if cache is None:
+        return ResPack(filename)
+
+    # parsing means opening every zip and its xml, so keep the parsed index around between runs
+    return cache.get_object('respack-%s' % stat_digest(filename), lambda: ResPack(filename))
 
 
 class ResPack(object):
@@ -80,35 +119,43 @@ class ResPack(object):
                 with zf.open(fn, 'r') as f:
                     self.parse_xml(f)
     
-    def open_image(self, name, height=720):
+    def open_image(self, name, height=720, image_class=Image, cache=None):
 
         if name not in self.images:
             raise ValueError('No image %s' % name)
         
         image_entry = self.images[name]
 
+        if cache is not None:
+            key = 'mask-%s' % hashlib.sha1(('%s:%s:%d:%s' % (stat_digest(self.filename), name, height, image_class.__name__)).encode()).hexdigest()
+            mask = cache.get_array(key, lambda: self._load_image(name, height, image_class).mask)
+            return image_class(height=height, mask=mask), image_entry
+
+        return self._load_image(name, height, image_class), image_entry
+
+    def _load_image(self, name, height, image_class):
+
         with ZipFile(self.filename, 'r') as zf:
 
             with zf.open(self.image_files[name], 'r') as f:
-                image = Image(f, os.path.basename(self.image_files[name]), height=height)
-
-        return image, image_entry
+                return image_class(f, os.path.basename(self.image_files[name]), height=height)
 
-    def open_song(self, name):
+    def open_song(self, name, path=None):
 
         if name not in self.songs:
             raise ValueError('No song %s' % name)
         
         song_entry = self.songs[name]
 
-        tempdir = mkdtemp()
+        if path is None:
+            path = mkdtemp()
 
         with ZipFile(self.filename, 'r') as zf:
             
-            loop_filename = zf.extract(self.audio_files[name], path=tempdir)
+            loop_filename = zf.extract(self.audio_files[name], path=path)
 
             if song_entry.buildup is not None:
-                buildup_filename = zf.extract(self.audio_files[song_entry.buildup], path=tempdir)
+                buildup_filename = zf.extract(self.audio_files[song_entry.buildup], path=path)
             else:
                 buildup_filename = None
         
@@ -0,0 +1,259 @@
+import threading
+import time
+
+import numpy as np
+
+from cache import file_digest
+from ffmpeg import open_audio_stream
+
+
+def compute_spectrogram(filename, n_fft=8192, hop_length=512, n_mels=512):
+
+    # librosa pulls in scipy and numba, so only import it when a spectrogram is actually computed
+    import librosa
+
+    samples, sr = librosa.load(filename, mono=True)
+    return np.maximum(0, -5 + librosa.power_to_db(librosa.feature.melspectrogram(y=samples, sr=sr, n_fft=n_fft, hop_length=hop_length, n_mels=n_mels)))
+
+
+def load_spectrogram(filename, n_fft=8192, hop_length=512, n_mels=512, cache=None):
+
+    if cache is None:
+        return compute_spectrogram(filename, n_fft=n_fft, hop_length=hop_length, n_mels=n_mels)
+
+    key = 'spectrogram-%s-%d-%d-%d' % (file_digest(filename), n_fft, hop_length, n_mels)
+    return cache.get_array(key, lambda: compute_spectrogram(filename, n_fft=n_fft, hop_length=hop_length, n_mels=n_mels))
+
+
+class StreamingSpectrogram(object):
+
+    def __init__(self, filename, duration, n_fft=8192, hop_length=512, n_mels=512, sample_rate=22050, ahead=256, behind=64, block_columns=16, loop=True, timeout=60.0):
+
+        import librosa
+
+        self.filename = filename
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.sample_rate = sample_rate
+        self.ahead = ahead
+        self.block_columns = block_columns
+        self.loop = loop
+        self.timeout = timeout
+
+        # same column count as a centred librosa analysis of the whole file
+        self.shape = (n_mels, int(duration * sample_rate) // hop_length + 1)
+        self.dtype = np.float32
+
+        # the loudest column up to the last one read, so that frames never depend on how far ahead the thread got
+        self.power_max = 0.0
+        self.analysed_power_max = 0.0
+
+        self.window = np.hanning(n_fft + 1)[:-1].astype(np.float32)
+        self.mel_basis = librosa.filters.mel(sr=sample_rate, n_fft=n_fft, n_mels=n_mels).astype(np.float32)
+        self.db_max = -np.inf
+
+        # a ring of the most recent columns; slots maps a column index to where it lives in the ring
+        self.capacity = ahead + behind
+        self.columns = np.zeros((n_mels, self.capacity), dtype=np.float32)
+        self.slot_columns = [None] * self.capacity
+        self.slot_seqs = [0] * self.capacity
+        self.slot_power_maxes = [0.0] * self.capacity
+        self.slots = {}
+        self.empty = np.zeros(n_mels, dtype=np.float32)
+
+        self.condition = threading.Condition()
+        self.seq = 0
+        self.requested_seq = 0
+        self.next_column = 0
+        self.seek_column = 0
+        self.end_column = None
+        self.error = None
+        self.closed = False
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __getitem__(self, index):
+
+        _, j = index
+        return self.column(j)
+
+    def column(self, j):
+
+        deadline = time.monotonic() + self.timeout
+
+        with self.condition:
+
+            # frames are rendered faster than real time, so wait for the column rather than drawing a blank
+            while j not in self.slots:
+
+                self._raise_error()
+
+                # the header duration can overestimate what actually decodes
+                if self.end_column is not None and j >= self.end_column:
+                    return self.empty
+
+                if self.seek_column is None:
+
+                    distance = j - self.next_column
+                    if self.loop:
+                        distance %= self.shape[1]
+
+                    # columns about to be computed are waited for; anything else restarts decoding there
+                    if 0 <= distance < self.capacity:
+                        self.requested_seq = self.seq + distance
+                    else:
+                        self.seek_column = j
+                        self.requested_seq = self.seq
+
+                self.condition.notify_all()
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('Column %d of %s was not analysed within %gs' % (j, self.filename, self.timeout))
+
+                self.condition.wait(remaining)
+
+            slot = self.slots[j]
+            self.requested_seq = self.slot_seqs[slot]
+            self.power_max = self.slot_power_maxes[slot]
+            column = self.columns[:, slot].copy()
+
+            self.condition.notify_all()
+
+        return column
+
+    def close(self):
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        self.thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+
+        if self.error is not None:
+            raise RuntimeError('Analysing %s failed' % self.filename) from self.error
+
+    def _run(self):
+
+        stream = None
+
+        try:
+            while True:
+
+                with self.condition:
+
+                    while not self.closed and self.seek_column is None and self.seq - self.requested_seq >= self.ahead:
+                        self.condition.wait()
+
+                    if self.closed:
+                        return
+
+                    seek_column, self.seek_column = self.seek_column, None
+
+                if seek_column is not None:
+
+                    if stream is not None:
+                        stream.kill()
+                        stream.wait()
+
+                    stream, buffer, column = self._open(seek_column)
+
+                data = stream.stdout.read(4 * self.hop_length * self.block_columns)
+
+                if data:
+                    buffer = np.concatenate((buffer, np.frombuffer(data, dtype=np.float32)))
+
+                else:
+                    # pad the end like a centred analysis, then either start over or wait for a seek
+                    buffer = np.concatenate((buffer, np.zeros(self.n_fft // 2, dtype=np.float32)))
+                    buffer, column = self._analyse(buffer, column)
+
+                    _, stderr = stream.communicate()
+                    if stream.returncode != 0:
+                        raise RuntimeError('ffmpeg could not decode %s: %s' % (self.filename, stderr.decode(errors='replace').strip()))
+                    stream = None
+
+                    with self.condition:
+
+                        self.end_column = column
+                        self.condition.notify_all()
+
+                        if self.loop:
+                            if self.seek_column is None:
+                                self.seek_column = 0
+                            continue
+
+                        while not self.closed and self.seek_column is None:
+                            self.condition.wait()
+
+                    continue
+
+                buffer, column = self._analyse(buffer, column)
+
+        except Exception as e:
+            # kept for the renderer, which would otherwise wait on a thread that is gone
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+
+        finally:
+            if stream is not None:
+                stream.kill()
+                stream.wait()
+
+    def _open(self, column):
+
+        start_sample = column * self.hop_length - self.n_fft // 2
+
+        if start_sample < 0:
+            buffer = np.zeros(-start_sample, dtype=np.float32)
+            start_sample = 0
+        else:
+            buffer = np.zeros(0, dtype=np.float32)
+
+        with self.condition:
+            self.next_column = column
+
+        return open_audio_stream(self.filename, sample_rate=self.sample_rate, start=start_sample / self.sample_rate), buffer, column
+
+    def _analyse(self, buffer, column):
+
+        if len(buffer) < self.n_fft:
+            return buffer, column
+
+        n = 1 + (len(buffer) - self.n_fft) // self.hop_length
+        frames = np.lib.stride_tricks.as_strided(buffer, shape=(n, self.n_fft), strides=(buffer.strides[0] * self.hop_length, buffer.strides[0]))
+
+        power = np.abs(np.fft.rfft(frames * self.window, axis=1)) ** 2
+        db = 10 * np.log10(np.maximum(1e-10, power.dot(self.mel_basis.T)))
+
+        # like power_to_db's top_db, but against the loudest column seen so far
+        self.db_max = max(self.db_max, np.max(db))
+        values = np.maximum(0, -5 + np.maximum(db, self.db_max - 80)).astype(np.float32)
+
+        with self.condition:
+
+            for k in range(n):
+
+                self.analysed_power_max = max(self.analysed_power_max, float(np.max(values[k])))
+
+                slot = self.seq % self.capacity
+                old_column = self.slot_columns[slot]
+                if old_column is not None and self.slots.get(old_column) == slot:
+                    del self.slots[old_column]
+
+                self.columns[:, slot] = values[k]
+                self.slot_columns[slot] = column + k
+                self.slot_seqs[slot] = self.seq
+                self.slot_power_maxes[slot] = self.analysed_power_max
+                self.slots[column + k] = slot
+                self.seq += 1
+
+            self.next_column = column + n
+            self.condition.notify_all()
+
+        return buffer[n * self.hop_length:].copy(), column + n
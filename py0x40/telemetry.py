@@ -0,0 +1,319 @@
+from collections import Counter
+import gc
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import pygame
+
+NUMPY_DOMAIN = getattr(np.lib, 'tracemalloc_domain', 389047)
+
+
+def current_rss():
+
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peak_rss()
+
+
+def peak_rss():
+
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def _call_site(depth):
+
+    frame = sys._getframe(depth + 1)
+    return '%s:%d %s' % (os.path.basename(frame.f_code.co_filename), frame.f_lineno, frame.f_code.co_name)
+
+
+def _surface_bytes(surface):
+
+    return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+
+class _TransformProxy(object):
+
+    def __init__(self, telemetry, transform):
+
+        self._telemetry = telemetry
+        self._transform = transform
+
+    def __getattr__(self, name):
+
+        function = getattr(self._transform, name)
+
+        def tracked(*args, **kwargs):
+
+            result = function(*args, **kwargs)
+            if isinstance(result, pygame.Surface):
+                self._telemetry.record_allocation(_call_site(1), _surface_bytes(result), kind='surface')
+            return result
+
+        return tracked
+
+
+class Telemetry(object):
+
+    def __init__(self, report_filename='telemetry.jsonl', interval=60.0, top=10, traceback_depth=1, sample_every=50):
+
+        self.report_filename = report_filename
+        self.interval = interval
+        self.top = top
+        self.traceback_depth = traceback_depth
+        self.sample_every = sample_every
+
+        self.patched = []
+        self.traced_files = set()
+        self.gc_start = None
+        self.sampling = False
+        self.started = False
+
+    def start(self, modules=()):
+
+        # counts Surfaces created in the given modules by wrapping their Surface and transform names
+        for module in modules:
+
+            if hasattr(module, '__file__'):
+                self.traced_files.add(module.__file__)
+
+            if hasattr(module, 'Surface'):
+                self._patch(module, 'Surface', self._tracked_surface_class(module.Surface))
+
+            if hasattr(module, 'transform'):
+                self._patch(module, 'transform', _TransformProxy(self, module.transform))
+
+        tracemalloc.start(self.traceback_depth)
+        gc.callbacks.append(self._gc_callback)
+
+        self.start_t = time.perf_counter()
+        self.frames = 0
+        self.snapshot = self._numpy_snapshot()
+        self._reset_window()
+        self.started = True
+
+    def close(self):
+
+        if not self.started:
+            return
+
+        self.report()
+
+        gc.callbacks.remove(self._gc_callback)
+        tracemalloc.stop()
+
+        for module, name, original in reversed(self.patched):
+            setattr(module, name, original)
+
+        self.patched = []
+        self.started = False
+
+    def frame_start(self):
+
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+        self.frame_traced, _ = tracemalloc.get_traced_memory()
+
+        # temporaries freed within a line never show up in a snapshot, so every Nth frame
+        # the instrumented modules are traced line by line and each line's peak is recorded
+        if self.sample_every and self.frames % self.sample_every == 0 and hasattr(tracemalloc, 'reset_peak'):
+            self.sampling = True
+            self.line_site = None
+            self.line_start = self.frame_traced
+            sys.settrace(self._trace_call)
+
+    def frame_end(self):
+
+        if self.sampling:
+            sys.settrace(None)
+            self._end_line(None)
+            self.sampling = False
+            self.sampled_frames += 1
+
+        traced, peak = tracemalloc.get_traced_memory()
+
+        self.frames += 1
+        self.window_frames += 1
+        self.window_transient += peak - self.frame_traced
+        self.window_max_transient = max(self.window_max_transient, peak - self.frame_traced)
+        self.window_growth += traced - self.frame_traced
+        self.rss_samples.append(current_rss())
+
+        if time.perf_counter() - self.window_start_t >= self.interval:
+            self.report()
+
+    def record_allocation(self, site, size, kind='surface'):
+
+        self.allocations[(kind, site)] += 1
+        self.allocation_bytes[(kind, site)] += size
+
+    def report(self):
+
+        frames = max(1, self.window_frames)
+        rss = self.rss_samples or [current_rss()]
+
+        snapshot = self._numpy_snapshot()
+        numpy_growth = [
+            {'site': str(stat.traceback), 'bytes': stat.size_diff, 'count': stat.count_diff}
+            for stat in snapshot.compare_to(self.snapshot, 'lineno')[:self.top] if stat.size_diff != 0
+        ]
+        self.snapshot = snapshot
+
+        sites = sorted(self.allocations, key=lambda key: -self.allocation_bytes[key])
+        sampled_frames = max(1, self.sampled_frames)
+
+        entry = {
+            'time': time.perf_counter() - self.start_t,
+            'frames': self.frames,
+            'window_frames': self.window_frames,
+            'allocations_per_frame': sum(self.allocations.values()) / frames,
+            'allocated_bytes_per_frame': sum(self.allocation_bytes.values()) / frames,
+            'allocation_sites': [
+                {
+                    'kind': kind,
+                    'site': site,
+                    'per_frame': self.allocations[(kind, site)] / frames,
+                    'bytes_per_frame': self.allocation_bytes[(kind, site)] / frames
+                }
+                for kind, site in sites[:self.top]
+            ],
+            'traced_transient_bytes_per_frame': self.window_transient / frames,
+            'traced_max_transient_bytes': self.window_max_transient,
+            'traced_growth_bytes': self.window_growth,
+            'numpy_traced_bytes': sum(stat.size for stat in snapshot.statistics('filename')),
+            'numpy_growth_sites': numpy_growth,
+            'sampled_frames': self.sampled_frames,
+            'transient_sites': [
+                {'site': site, 'bytes_per_frame': size / sampled_frames}
+                for site, size in self.line_peaks.most_common(self.top)
+            ],
+            'rss_bytes': rss[-1],
+            'rss_steady_bytes': sorted(rss)[len(rss) // 2],
+            'rss_peak_bytes': peak_rss(),
+            'gc_collections': self.gc_collections,
+            'gc_pause_total': self.gc_pause_total,
+            'gc_pause_max': self.gc_pause_max
+        }
+
+        with open(self.report_filename, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+        self._reset_window()
+
+        return entry
+
+    def _reset_window(self):
+
+        self.window_start_t = time.perf_counter()
+        self.window_frames = 0
+        self.window_transient = 0
+        self.window_max_transient = 0
+        self.window_growth = 0
+        self.rss_samples = []
+
+        self.allocations = Counter()
+        self.allocation_bytes = Counter()
+
+        self.sampled_frames = 0
+        self.line_peaks = Counter()
+
+        self.gc_collections = Counter()
+        self.gc_pause_total = 0.0
+        self.gc_pause_max = 0.0
+
+    def _trace_call(self, frame, event, arg):
+
+        if frame.f_code.co_filename not in self.traced_files:
+            return None
+
+        self._end_line(None)
+        return self._trace_line
+
+    def _trace_line(self, frame, event, arg):
+
+        if event == 'line':
+            self._end_line(frame)
+
+        elif event == 'return':
+            # the rest of the caller's line is charged to the caller, when it is traced too
+            caller = frame.f_back
+            self._end_line(caller if caller is not None and caller.f_code.co_filename in self.traced_files else None)
+
+        return self._trace_line
+
+    def _end_line(self, next_frame):
+
+        traced, peak = tracemalloc.get_traced_memory()
+
+        if self.line_site is not None and peak > self.line_start:
+            self.line_peaks[self.line_site] += peak - self.line_start
+
+        if next_frame is None:
+            self.line_site = None
+        else:
+            self.line_site = '%s:%d %s' % (os.path.basename(next_frame.f_code.co_filename), next_frame.f_lineno, next_frame.f_code.co_name)
+
+        tracemalloc.reset_peak()
+        self.line_start, _ = tracemalloc.get_traced_memory()
+
+    def _numpy_snapshot(self):
+
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.DomainFilter(True, NUMPY_DOMAIN)])
+
+    def _gc_callback(self, phase, info):
+
+        if phase == 'start':
+            self.gc_start = time.perf_counter()
+
+        elif self.gc_start is not None:
+            pause = time.perf_counter() - self.gc_start
+            self.gc_start = None
+            self.gc_collections[str(info['generation'])] += 1
+            self.gc_pause_total += pause
+            self.gc_pause_max = max(self.gc_pause_max, pause)
+
+    def _patch(self, module, name, replacement):
+
+        self.patched.append((module, name, getattr(module, name)))
+        setattr(module, name, replacement)
+
+    def _tracked_surface_class(self, surface_class):
+
+        telemetry = self
+
+        class TrackedSurface(surface_class):
+
+            def __init__(self, *args, **kwargs):
+
+                super().__init__(*args, **kwargs)
+                telemetry.record_allocation(_call_site(1), _surface_bytes(self), kind='surface')
+
+            def convert(self, *args):
+
+                surface = super().convert(*args)
+                telemetry.record_allocation(_call_site(1), _surface_bytes(surface), kind='surface')
+                return surface
+
+            def convert_alpha(self, *args):
+
+                surface = super().convert_alpha(*args)
+                telemetry.record_allocation(_call_site(1), _surface_bytes(surface), kind='surface')
+                return surface
+
+            def copy(self):
+
+                surface = super().copy()
+                telemetry.record_allocation(_call_site(1), _surface_bytes(surface), kind='surface')
+                return surface
+
+        return TrackedSurface
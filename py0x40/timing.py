@@ -0,0 +1,48 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import time
+
+
+class StageTimer(object):
+
+    def __init__(self, start=None):
+
+        self.start = time.perf_counter() if start is None else start
+        self.end = None
+        self.stages = OrderedDict()
+        self.counts = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, elapsed):
+
+        self.stages[name] = self.stages.get(name, 0.0) + elapsed
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def stop(self):
+
+        # freezes the total reported, e.g. at the first frame rather than after the render
+        self.end = time.perf_counter()
+
+    def elapsed(self):
+
+        return (time.perf_counter() if self.end is None else self.end) - self.start
+
+    def report(self, title='timings'):
+
+        total = self.elapsed()
+        width = max([len(name) for name in self.stages] + [5])
+
+        lines = ['%s (%.3fs total)' % (title, total)]
+        for name, elapsed in self.stages.items():
+            lines.append('  %-*s %8.3fs %5.1f%%' % (width, name, elapsed, 100 * elapsed / total if total > 0 else 0.0))
+
+        return '\n'.join(lines)